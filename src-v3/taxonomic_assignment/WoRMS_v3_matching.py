@@ -1,16 +1,65 @@
-import pyworms
 import pandas as pd
-import multiprocess as mp
+import numpy as np
+import asyncio
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import os
 import time
-from functools import partial
+import pickle
+import random
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import re
 
+# orjson parses the WoRMS responses several times faster; fall back to the standard library if it's missing
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    import json
+    _json_loads = json.loads
+
 # Set up logging to provide clear progress updates
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Standard Darwin Core ranks used for structuring the output
 DWC_RANKS_STD = ['kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+# WoRMS record keys for the ranks are already lowercase, so they can be used as-is
+_RANK_KEYS = tuple(DWC_RANKS_STD)
+
+WORMS_REST_URL = 'https://www.marinespecies.org/rest'
+
+# Columns of the per-taxon result records, which are stored as plain tuples in this order
+RESULT_COLUMNS = ('scientificName', 'scientificNameID', 'taxonRank', 'nameAccordingTo',
+                  'match_type_debug', 'cleanedTaxonomy', *DWC_RANKS_STD)
+
+# Shared fields of every 'incertae sedis' record (nameAccordingTo and match_type_debug are added per case)
+_INCERTAE_SEDIS = {
+    'scientificName': 'incertae sedis',
+    'scientificNameID': 'urn:lsid:marinespecies.org:taxname:12',
+    'taxonRank': None,
+    **dict.fromkeys(_RANK_KEYS)
+}
+
+# Precompiled cleaning patterns for parse_semicolon_taxonomy
+_TRANS = str.maketrans('_-/', '   ')
+_DIGITS = re.compile(r'\d+')
+_WS = re.compile(r'\s+')
+
+# Max AphiaIDs per AphiaRecordsByAphiaIDs request (WoRMS limit)
+_APHIA_IDS_PER_REQUEST = 50
+
+# Transient WoRMS responses (rate limiting and server errors) that are retried with exponential backoff
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+_MAX_RETRIES = 4
+
+# pd.concat's copy keyword avoids a copy before pandas 3.0, but is deprecated from 3.0 on (copy-on-write)
+_CONCAT_NO_COPY = {'copy': False} if int(pd.__version__.split('.')[0]) < 3 else {}
+
+# Shared requests session for resending failed stage 2 batches, created lazily by _get_session()
+_SESSION = None
 
 def parse_semicolon_taxonomy(tax_string):
     """
@@ -19,8 +68,8 @@ def parse_semicolon_taxonomy(tax_string):
     if pd.isna(tax_string) or not str(tax_string).strip():
         return []
     
-    # Fast string cleaning with chained replacements
-    cleaned_string = str(tax_string).replace('_', ' ').replace('-', ' ').replace('/', ' ')
+    # Fast string cleaning with a single translate pass
+    cleaned_string = str(tax_string).translate(_TRANS)
     
     # Split and clean in one pass
     cleaned_names = []
@@ -34,11 +83,11 @@ def parse_semicolon_taxonomy(tax_string):
         
         # Remove numbers - only use regex once per name if needed
         if any(char.isdigit() for char in name):
-            name = re.sub(r'\d+', '', name)
+            name = _DIGITS.sub('', name)
         
         # Collapse multiple spaces - only if needed
         if '  ' in name:
-            name = re.sub(r'\s+', ' ', name)
+            name = _WS.sub(' ', name)
         
         name = name.strip()
         if name and len(name) > 1:
@@ -46,57 +95,219 @@ def parse_semicolon_taxonomy(tax_string):
     
     return cleaned_names
 
-def get_worms_classification_by_id_worker(aphia_id_to_check, api_source_for_record='WoRMS'):
+def _make_record(**fields):
+    """Packs a result into a compact tuple ordered like RESULT_COLUMNS (missing fields become None)."""
+    return tuple(fields.get(col) for col in RESULT_COLUMNS)
+
+def _format_worms_match(match):
+    """Builds the result dict (name, LSID, rank and DwC rank columns) from a WoRMS record."""
+    return {
+        'scientificName': match.get('scientificname'),
+        'scientificNameID': match.get('lsid'),
+        'taxonRank': match.get('rank'),
+        # Add rank columns
+        **{rank: match.get(rank) for rank in _RANK_KEYS}
+    }
+
+def _backoff_delay(attempt):
+    """Exponential backoff with jitter, capped at 30 seconds."""
+    return min(30, 0.5 * 2 ** attempt) + random.random()
+
+async def _get_worms_json(session, semaphore, url, params=None):
+    """GETs a WoRMS REST endpoint and returns the parsed JSON (None for 204 No Content).
+    Connection errors, timeouts, 429 and 5xx responses are retried with backoff; other error statuses raise."""
+    for attempt in range(_MAX_RETRIES + 1):
+        try:
+            async with semaphore, session.get(url, params=params) as resp:
+                if resp.status == 204:
+                    return None
+                if resp.status not in _RETRY_STATUSES or attempt == _MAX_RETRIES:
+                    resp.raise_for_status()
+                    return _json_loads(await resp.read())
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == _MAX_RETRIES:
+                raise
+        # Sleep outside the semaphore so other requests can use the slot meanwhile
+        await asyncio.sleep(_backoff_delay(attempt))
+
+async def _fetch_aphia_records(session, semaphore, aphia_ids):
+    """Fetches up to 50 WoRMS records in one bulk request. Returns {AphiaID: record}; IDs without a record are absent."""
+    params = [('aphiaids[]', str(aphia_id)) for aphia_id in aphia_ids]
+    records = await _get_worms_json(session, semaphore, f"{WORMS_REST_URL}/AphiaRecordsByAphiaIDs", params=params)
+    return {record['AphiaID']: record for record in records or [] if record}
+
+class _AphiaRecordLoader:
+    """Coalesces AphiaID lookups issued within a short window into bulk AphiaRecordsByAphiaIDs
+    requests (DataLoader pattern), so N concurrent lookups cost one round-trip per 50 IDs.
+    Must be created inside the running event loop."""
+
+    def __init__(self, session, semaphore, delay=0.01):
+        self._session = session
+        self._semaphore = semaphore
+        self._delay = delay
+        self._loop = asyncio.get_running_loop()
+        self._pending = {}
+        self._flush_handle = None
+        self._dispatch_tasks = set()
+
+    def load(self, aphia_id):
+        """Returns a future resolving to the WoRMS record for aphia_id (None if WoRMS has no record)."""
+        future = self._pending.get(aphia_id)
+        if future is None:
+            future = self._loop.create_future()
+            self._pending[aphia_id] = future
+            if len(self._pending) >= _APHIA_IDS_PER_REQUEST:
+                self._flush()
+            elif self._flush_handle is None:
+                self._flush_handle = self._loop.call_later(self._delay, self._flush)
+        return future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        if pending:
+            task = self._loop.create_task(self._dispatch(pending))
+            # Keep a reference until done so the task isn't garbage collected mid-flight
+            self._dispatch_tasks.add(task)
+            task.add_done_callback(self._dispatch_tasks.discard)
+
+    async def _dispatch(self, pending):
+        try:
+            records = await _fetch_aphia_records(self._session, self._semaphore, list(pending))
+        except Exception as e:
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for aphia_id, future in pending.items():
+            if not future.done():
+                future.set_result(records.get(aphia_id))
+
+def _match_names_params(chunk):
+    """Query parameters for the WoRMS AphiaRecordsByMatchNames endpoint."""
+    return [('scientificnames[]', name) for name in chunk] + [('marine_only', 'true')]
+
+async def _fetch_match_names(session, semaphore, chunk):
+    """Queries the WoRMS name matching service for a batch of (max 50) names. Raises if the batch ultimately fails."""
+    params = _match_names_params(chunk)
+    # 204 (None) means none of the names matched
+    return await _get_worms_json(session, semaphore, f"{WORMS_REST_URL}/AphiaRecordsByMatchNames", params=params) or []
+
+def _get_session():
+    """Returns the shared requests session, so keep-alive reuses one TLS connection across calls."""
+    global _SESSION
+    if _SESSION is None:
+        _SESSION = requests.Session()
+        retries = Retry(total=_MAX_RETRIES, backoff_factor=0.5, status_forcelist=sorted(_RETRY_STATUSES),
+                        respect_retry_after_header=True)
+        _SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retries))
+    return _SESSION
+
+def _fetch_match_names_sync(chunk):
+    """Synchronous version of _fetch_match_names, used to resend batches that failed on the async path."""
+    resp = _get_session().get(f"{WORMS_REST_URL}/AphiaRecordsByMatchNames", params=_match_names_params(chunk), timeout=30)
+    if resp.status_code == 204:
+        return []
+    resp.raise_for_status()
+    return _json_loads(resp.content)
+
+async def get_worms_classification_by_id_worker(loader, aphia_id_to_check, api_source_for_record='WoRMS'):
     """Fetches and formats a full WoRMS record using a direct AphiaID.
-    Used by local database pre-matching. Example uses Silva PR2 database"""
+    Used by local database pre-matching. Example uses Silva PR2 database.
+    'Failure_' means WoRMS has no accepted record for the ID; 'Error_' means the lookup itself failed."""
     try:
-        record = pyworms.aphiaRecordByAphiaID(aphia_id_to_check)
-        
-        if record and isinstance(record, dict) and record.get('status') == 'accepted':
-            result = {
-                'scientificName': record.get('scientificname'), 'scientificNameID': record.get('lsid'),
-                'taxonRank': record.get('rank'), 'nameAccordingTo': api_source_for_record,
-                'match_type_debug': f'Success_AphiaID_{aphia_id_to_check}'
-            }
-            for rank_std in DWC_RANKS_STD:
-                result[rank_std] = record.get(rank_std.lower())
-            return aphia_id_to_check, result
+        record = await loader.load(aphia_id_to_check)
     except Exception:
-        pass
+        # Still failing after retries: report as transient so the result isn't cached
+        return aphia_id_to_check, {'match_type_debug': f'Error_AphiaID_{aphia_id_to_check}'}
+        
+    if record and isinstance(record, dict) and record.get('status') == 'accepted':
+        result = _format_worms_match(record)
+        result['nameAccordingTo'] = api_source_for_record
+        result['match_type_debug'] = f'Success_AphiaID_{aphia_id_to_check}'
+        return aphia_id_to_check, result
     
     return aphia_id_to_check, {'match_type_debug': f'Failure_AphiaID_{aphia_id_to_check}'}
 
-def get_worms_batch_worker(batch_info):
-    """Worker function for parallel batch processing - with timeout safety."""
-    batch_num, chunk = batch_info
+def _accepted_matches_by_name(chunk, batch_results_raw):
+    """Maps each name in the chunk to its first accepted WoRMS match (if any)."""
     batch_results = {}
+    for j, name_list in enumerate(batch_results_raw or []):
+        if name_list:
+            # Find first accepted match
+            for match in name_list:
+                if match and match.get('status') == 'accepted':
+                    batch_results[chunk[j]] = _format_worms_match(match)
+                    break  # Found accepted match, stop looking
+    return batch_results
+
+async def get_worms_batch_worker(session, semaphore, batch_info):
+    """Async worker for batch name matching. Returns None instead of the results for a failed batch."""
+    batch_num, chunk = batch_info
     
     try:
-        batch_results_raw = pyworms.aphiaRecordsByMatchNames(chunk)
-        
-        # Process results efficiently
-        for j, name_list in enumerate(batch_results_raw):
-            if name_list:
-                # Find first accepted match
-                for match in name_list:
-                    if match and match.get('status') == 'accepted':
-                        # Build result dict efficiently
-                        res = {
-                            'scientificName': match.get('scientificname'),
-                            'scientificNameID': match.get('lsid'), 
-                            'taxonRank': match.get('rank')
-                        }
-                        # Add rank columns
-                        for rank in DWC_RANKS_STD:
-                            res[rank] = match.get(rank.lower())
-                        
-                        batch_results[chunk[j]] = res
-                        break  # Found accepted match, stop looking
-        
-        return batch_num, batch_results
+        batch_results_raw = await _fetch_match_names(session, semaphore, chunk)
+        return batch_num, _accepted_matches_by_name(chunk, batch_results_raw)
         
     except Exception as e:
-        return batch_num, {}
+        # Reached only after all retries failed; these names end up unmatched for this run
+        logging.error(f"Error in batch {batch_num}: {e}")
+        return batch_num, None
+
+def _deepest_matched_term(parsed_names, batch_lookup):
+    """Returns the most specific term of a parsed taxonomy that has a batch match, or None."""
+    for term in reversed(parsed_names):
+        if term in batch_lookup:
+            return term
+    return None
+
+def get_worms_batch_worker_sync(batch_info):
+    """Thread worker for batch name matching via the shared requests session. Returns None for a failed batch."""
+    batch_num, chunk = batch_info
+    batch_start = time.time()
+    
+    try:
+        batch_results_raw = _fetch_match_names_sync(chunk)
+        logging.info(f"  Batch {batch_num} completed in {time.time() - batch_start:.1f}s")
+        return batch_num, _accepted_matches_by_name(chunk, batch_results_raw)
+        
+    except Exception as batch_e:
+        logging.error(f"Error in batch {batch_num}: {batch_e}")
+        return batch_num, None
+
+def _worms_client_session(n_conn):
+    """Creates an aiohttp session whose connections (and TLS handshakes) are reused across all calls."""
+    connector = aiohttp.TCPConnector(limit=n_conn, keepalive_timeout=75, ttl_dns_cache=300)
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=120))
+
+async def _fetch_all_aphia_ids(aphia_ids, api_source, n_conn):
+    """Stage 1: looks up all AphiaIDs concurrently (coalesced into bulk requests), with at most n_conn requests in flight."""
+    semaphore = asyncio.Semaphore(n_conn)
+    async with _worms_client_session(n_conn) as session:
+        loader = _AphiaRecordLoader(session, semaphore)
+        return await asyncio.gather(*[
+            get_worms_classification_by_id_worker(loader, aphia_id, api_source_for_record=api_source)
+            for aphia_id in aphia_ids
+        ])
+
+async def _fetch_all_batches(batch_data, n_conn):
+    """Stage 2: runs all name-matching batches concurrently, with at most n_conn requests in flight."""
+    semaphore = asyncio.Semaphore(n_conn)
+    async with _worms_client_session(n_conn) as session:
+        return await asyncio.gather(*[
+            get_worms_batch_worker(session, semaphore, batch_info) for batch_info in batch_data
+        ])
+
+def _run_async(coro):
+    """Runs a coroutine to completion, also when called from a running event loop (e.g. Jupyter)."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
 
 def get_worms_match_for_dataframe(occurrence_df, params_dict, n_proc=0):
     """Adds WoRMS taxonomic information using a simple, working approach."""
@@ -106,47 +317,77 @@ def get_worms_match_for_dataframe(occurrence_df, params_dict, n_proc=0):
     # Handle case where parameter is None
     if assays_to_skip_species is None:
         assays_to_skip_species = []
+    assays_to_skip_species = frozenset(assays_to_skip_species)
         
     pr2_dict = params_dict.get('pr2_worms_dict', {})
     assay_rank_info = params_dict.get('assay_rank_info', {})
 
-    # WoRMS API doesn't like when you have more procesess...
+    # WoRMS API doesn't like when you have more concurrent requests...
     if n_proc == 0:
-        n_proc = min(3, mp.cpu_count())  # Max 3 processes instead of 8!
+        n_proc = 3  # Max 3 concurrent requests
     else:
-        n_proc = min(n_proc, 3)  # Cap at 3 processes
+        n_proc = min(n_proc, 3)  # Cap at 3 concurrent requests
+    
+    logging.info(f"Using {n_proc} concurrent requests for WoRMS matching (recommended to have a max of 3 for API stability)")
+
+    # --- Caching Setup ---
+    # WoRMS responses are cached per AphiaID and per name, so reruns only query new taxa
+    output_dir = params_dict.get('output_dir', '.')
+    os.makedirs(output_dir, exist_ok=True)
+    cache_file = os.path.join(output_dir, 'worms_matches.pkl')
     
-    logging.info(f"Using {n_proc} processes for WoRMS matching (recommended to have a max of 3 for API stability)")
+    try:
+        with open(cache_file, 'rb') as f:
+            worms_cache = pickle.load(f)
+        logging.info(f"Loaded {len(worms_cache['aphia_ids'])} AphiaID and {len(worms_cache['names'])} name results from WoRMS cache file: {cache_file}")
+    except (FileNotFoundError, EOFError):
+        worms_cache = {'aphia_ids': {}, 'names': {}}
+        logging.info("No WoRMS cache file found or cache is empty. Starting fresh.")
+    aphia_id_cache = worms_cache['aphia_ids']
+    name_cache = worms_cache['names']
+    cache_updated = False
 
-    df_to_process = occurrence_df.copy()
+    # The input DataFrame is only read here; no full copy is made for scratch work
+    verbatim_col = occurrence_df['verbatimIdentification']
+    assay_col = occurrence_df['assay_name']
 
     # --- Handle empty verbatim strings ---
-    empty_verbatim_mask = (df_to_process['verbatimIdentification'].isna()) | \
-                          (df_to_process['verbatimIdentification'].str.strip() == '') | \
-                          (df_to_process['verbatimIdentification'].str.strip().str.lower() == 'unassigned')
+    empty_verbatim_mask = (verbatim_col.isna()) | \
+                          (verbatim_col.str.strip() == '') | \
+                          (verbatim_col.str.strip().str.lower() == 'unassigned')
     
-    df_to_process['_map_key'] = ''
-    df_to_process.loc[empty_verbatim_mask, '_map_key'] = 'IS_TRULY_EMPTY'
+    # Vectorized string key per row: verbatim + unit separator + assay name, built in a single assignment
+    # NaNs are filled first: newer pandas keeps them as NaN through astype(str), which breaks the concatenation
+    composite_key = (verbatim_col.fillna('').astype(str).values.astype(object) + '\x1f' +
+                     assay_col.fillna('').astype(str).values.astype(object))
+    map_key = pd.Series(np.where(empty_verbatim_mask.values, 'IS_TRULY_EMPTY', composite_key), index=occurrence_df.index)
     
     non_empty_mask = ~empty_verbatim_mask
     
-    keys_to_assign = pd.Series(
-        list(zip(
-            df_to_process.loc[non_empty_mask, 'verbatimIdentification'],
-            df_to_process.loc[non_empty_mask, 'assay_name']
-        )),
-        index=df_to_process[non_empty_mask].index
-    )
-    df_to_process.loc[non_empty_mask, '_map_key'] = keys_to_assign
+    # Companion lookup from the composite key back to the (verbatim, assay) tuple used for matching
+    # Key, verbatim and assay are taken positionally from the same rows, so duplicate index labels can't mix them up
+    non_empty_positions = np.flatnonzero(non_empty_mask.values)
+    unique_rows = pd.DataFrame({
+        'key': map_key.values[non_empty_positions],
+        'verbatim': verbatim_col.values[non_empty_positions],
+        'assay': assay_col.values[non_empty_positions]
+    }).drop_duplicates('key')
+    tuple_by_key = dict(zip(unique_rows['key'], zip(unique_rows['verbatim'], unique_rows['assay'])))
     
-    unique_tuples_to_process = list(df_to_process.loc[non_empty_mask, '_map_key'].drop_duplicates())
+    unique_tuples_to_process = list(tuple_by_key.values())
     logging.info(f"Found {len(unique_tuples_to_process)} unique, non-empty combinations to process.")
 
+    # Parse each verbatim string once, no matter how many assays it appears under
+    parsed_by_verbatim = {vt: parse_semicolon_taxonomy(vt) for vt in set(vt for vt, _ in unique_tuples_to_process)}
+    cleaned_by_verbatim = {vt: ';'.join(names) if names else vt for vt, names in parsed_by_verbatim.items()}
+    max_depth_by_assay = {a: assay_rank_info.get(a, {}).get('max_depth', 99) for a in set(a for _, a in unique_tuples_to_process)}
+
     results_cache = {}
     unmatched_tuples = []
     
     # Handle cases that should get 'incertae sedis' immediately
-    cases_to_handle = []
+    incertae_sedis_base = {**_INCERTAE_SEDIS, 'nameAccordingTo': api_source}
+    cases_to_handle = set()
     for verbatim_str, assay_name in unique_tuples_to_process:
         # First check for unassigned/empty cases  
         cleaned_verbatim = str(verbatim_str).strip().rstrip(';').strip()
@@ -155,41 +396,27 @@ def get_worms_match_for_dataframe(occurrence_df, params_dict, n_proc=0):
         if (not cleaned_verbatim or 
             cleaned_verbatim.lower() in ['unassigned', 'nan', 'none', ''] or
             pd.isna(verbatim_str)):
-            incertae_sedis_record = {
-                'scientificName': 'incertae sedis',
-                'scientificNameID': 'urn:lsid:marinespecies.org:taxname:12',
-                'taxonRank': None,
-                'nameAccordingTo': api_source,
-                'match_type_debug': 'incertae_sedis_unassigned',
-                'cleanedTaxonomy': cleaned_verbatim  # Store what was actually processed
-            }
-            for col in DWC_RANKS_STD:
-                incertae_sedis_record[col] = None
-            results_cache[(verbatim_str, assay_name)] = incertae_sedis_record
-            cases_to_handle.append((verbatim_str, assay_name))
+            match_type_debug = 'incertae_sedis_unassigned'
         # Then check for simple kingdom-only cases
         elif cleaned_verbatim.lower() in ['eukaryota']:  # Only assign incertae sedis to Eukaryota, not bacteria
-            incertae_sedis_record = {
-                'scientificName': 'incertae sedis',
-                'scientificNameID': 'urn:lsid:marinespecies.org:taxname:12',
-                'taxonRank': None,
-                'nameAccordingTo': api_source,
-                'match_type_debug': f'incertae_sedis_simple_case_{cleaned_verbatim}',
-                'cleanedTaxonomy': cleaned_verbatim  # Store what was actually processed
-            }
-            for col in DWC_RANKS_STD:
-                incertae_sedis_record[col] = None
-            results_cache[(verbatim_str, assay_name)] = incertae_sedis_record
-            cases_to_handle.append((verbatim_str, assay_name))
+            match_type_debug = f'incertae_sedis_simple_case_{cleaned_verbatim}'
+        else:
+            continue
+        results_cache[(verbatim_str, assay_name)] = _make_record(
+            **incertae_sedis_base,
+            match_type_debug=match_type_debug,
+            cleanedTaxonomy=cleaned_verbatim  # Store what was actually processed
+        )
+        cases_to_handle.add((verbatim_str, assay_name))
     
-    # Remove handled cases from further processing
+    # Remove handled cases from further processing (set membership keeps this O(N))
     unique_tuples_to_process = [t for t in unique_tuples_to_process if t not in cases_to_handle]
     if cases_to_handle:
         logging.info(f"Assigned {len(cases_to_handle)} cases (unassigned/empty/simple kingdoms) to 'incertae sedis'.")
 
     # --- Stage 1: PR2 AphiaID Pre-matching ---
     if pr2_dict:
-        logging.info("Starting Stage 1: Parallel AphiaID pre-matching.")
+        logging.info("Starting Stage 1: Concurrent AphiaID pre-matching.")
         aphia_id_map = {}
         
         for verbatim_str, assay_name in unique_tuples_to_process:
@@ -198,7 +425,7 @@ def get_worms_match_for_dataframe(occurrence_df, params_dict, n_proc=0):
                 unmatched_tuples.append((verbatim_str, assay_name))
                 continue
                 
-            parsed_names = parse_semicolon_taxonomy(verbatim_str)
+            parsed_names = parsed_by_verbatim[verbatim_str]
             if parsed_names:
                 species_name = parsed_names[-1]
                 if species_name in pr2_dict:
@@ -209,24 +436,25 @@ def get_worms_match_for_dataframe(occurrence_df, params_dict, n_proc=0):
                     continue
             unmatched_tuples.append((verbatim_str, assay_name))
         
-        unique_aphia_ids_to_fetch = list(aphia_id_map.keys())
+        unique_aphia_ids_to_fetch = [aphia_id for aphia_id in aphia_id_map if aphia_id not in aphia_id_cache]
+        logging.info(f"{len(aphia_id_map) - len(unique_aphia_ids_to_fetch)} of {len(aphia_id_map)} AphiaIDs found in cache.")
         if unique_aphia_ids_to_fetch:
-            with mp.Pool(processes=n_proc) as pool:
-                worker_func = partial(get_worms_classification_by_id_worker, api_source_for_record=api_source)
-                parallel_results = pool.map(worker_func, unique_aphia_ids_to_fetch)
+            parallel_results = _run_async(_fetch_all_aphia_ids(unique_aphia_ids_to_fetch, api_source, n_proc))
 
+            # Successes and permanent failures are cached; transient errors are retried on the next run
             for aphia_id, result in parallel_results:
-                if 'scientificName' in result:
-                    for combo in aphia_id_map.get(aphia_id, []):
-                        # Add cleaned taxonomy info for PR2 matches
-                        verbatim_str, assay_name = combo
-                        parsed_names = parse_semicolon_taxonomy(verbatim_str)
-                        cleaned_taxonomy = ';'.join(parsed_names) if parsed_names else verbatim_str
-                        result_with_cleaned = result.copy()
-                        result_with_cleaned['cleanedTaxonomy'] = cleaned_taxonomy
-                        results_cache[combo] = result_with_cleaned
-                else:
-                    unmatched_tuples.extend(aphia_id_map.get(aphia_id, []))
+                if not result['match_type_debug'].startswith('Error_'):
+                    aphia_id_cache[aphia_id] = result
+                    cache_updated = True
+
+        for aphia_id in aphia_id_map:
+            result = aphia_id_cache.get(aphia_id, {})
+            if 'scientificName' in result:
+                for combo in aphia_id_map[aphia_id]:
+                    # Add cleaned taxonomy info for PR2 matches
+                    results_cache[combo] = _make_record(**result, cleanedTaxonomy=cleaned_by_verbatim[combo[0]])
+            else:
+                unmatched_tuples.extend(aphia_id_map[aphia_id])
         
         logging.info(f"Finished Stage 1. Matched {len(results_cache)} taxa via AphiaID. Remaining: {len(unmatched_tuples)}.")
     else:
@@ -234,83 +462,75 @@ def get_worms_match_for_dataframe(occurrence_df, params_dict, n_proc=0):
 
     # --- Stage 2: SMART Parallel Batch Name Matching ---
     if unmatched_tuples:
-        all_terms_to_match = list(set(term for vt, an in unmatched_tuples for term in parse_semicolon_taxonomy(vt)))
+        all_terms_to_match = list({term for vt, _ in unmatched_tuples for term in parsed_by_verbatim[vt]})
         logging.info(f"Starting Stage 2: Smart parallel batch matching for {len(all_terms_to_match)} unique terms.")
         
-        batch_lookup = {}
+        # Names seen on a previous run don't need to be queried again (None = no accepted match)
+        batch_lookup = {term: name_cache[term] for term in all_terms_to_match if name_cache.get(term)}
+        terms_to_query = [term for term in all_terms_to_match if term not in name_cache]
+        logging.info(f"{len(all_terms_to_match) - len(terms_to_query)} of {len(all_terms_to_match)} terms found in cache.")
+        
         if all_terms_to_match:
             # Use batch size of 50 as recommended by WoRMS API
             chunk_size = 50
-            total_batches = (len(all_terms_to_match) + chunk_size - 1) // chunk_size
+            total_batches = (len(terms_to_query) + chunk_size - 1) // chunk_size
             
-            # Prepare batch data for SMART parallel processing
+            # Prepare batch data for concurrent processing
             batch_data = []
-            for i in range(0, len(all_terms_to_match), chunk_size):
+            for i in range(0, len(terms_to_query), chunk_size):
                 batch_num = (i // chunk_size) + 1
-                chunk = all_terms_to_match[i:i+chunk_size]
+                chunk = terms_to_query[i:i+chunk_size]
                 batch_data.append((batch_num, chunk))
             
-            logging.info(f"Processing {total_batches} batches with {n_proc} processes (API-friendly)...")
+            logging.info(f"Processing {total_batches} batches with {n_proc} concurrent requests (API-friendly)...")
             
             try:
-                # Process batches in parallel with smaller pool
-                with mp.Pool(processes=n_proc) as pool:
-                    parallel_batch_results = pool.map(get_worms_batch_worker, batch_data)
-                
-                # Combine results
-                total_matches = 0
-                for batch_num, batch_result in parallel_batch_results:
-                    batch_lookup.update(batch_result)
-                    total_matches += len(batch_result)
-                
-                logging.info(f"Smart parallel processing complete! Found {total_matches} matches across {total_batches} batches.")
+                # All batches are in flight at once, bounded by the semaphore
+                parallel_batch_results = _run_async(_fetch_all_batches(batch_data, n_proc)) if batch_data else []
                 
             except Exception as e:
-                logging.error(f"Parallel processing failed: {e}")
-                logging.info("Falling back to sequential processing...")
-                
-                # Fallback to sequential if parallel fails
-                for i in range(0, len(all_terms_to_match), chunk_size):
-                    batch_num = (i // chunk_size) + 1
-                    chunk = all_terms_to_match[i:i+chunk_size]
-                    
-                    logging.info(f"Processing batch {batch_num}/{total_batches} sequentially...")
-                    batch_start = time.time()
-                    
-                    try:
-                        batch_results_raw = pyworms.aphiaRecordsByMatchNames(chunk)
-                        
-                        for j, name_list in enumerate(batch_results_raw):
-                            if name_list:
-                                for match in name_list:
-                                    if match and match.get('status') == 'accepted':
-                                        res = {
-                                            'scientificName': match.get('scientificname'),
-                                            'scientificNameID': match.get('lsid'), 
-                                            'taxonRank': match.get('rank')
-                                        }
-                                        for rank in DWC_RANKS_STD:
-                                            res[rank] = match.get(rank.lower())
-                                        
-                                        batch_lookup[chunk[j]] = res
-                                        break
-                        
-                        batch_time = time.time() - batch_start
-                        logging.info(f"  Batch {batch_num} completed in {batch_time:.1f}s")
-                        
-                    except Exception as batch_e:
-                        logging.error(f"Error in batch {batch_num}: {batch_e}")
+                logging.error(f"Concurrent processing failed: {e}")
+                parallel_batch_results = [(batch_num, None) for batch_num, _ in batch_data]
+            
+            # Resend failed batches on threads sharing one requests session. The calls are I/O-bound,
+            # so threads give the same concurrency as processes without the startup and pickling cost
+            failed_batches = [batch_data[batch_num - 1] for batch_num, batch_result in parallel_batch_results if batch_result is None]
+            if failed_batches:
+                logging.info(f"Retrying {len(failed_batches)} failed batches with {n_proc} threads sharing one requests session...")
+                with ThreadPoolExecutor(max_workers=n_proc) as executor:
+                    retried_results = dict(executor.map(get_worms_batch_worker_sync, failed_batches))
+                parallel_batch_results = [
+                    (batch_num, retried_results[batch_num] if batch_result is None else batch_result)
+                    for batch_num, batch_result in parallel_batch_results
+                ]
+            
+            # Combine results
+            total_matches = 0
+            for batch_num, batch_result in parallel_batch_results:
+                if batch_result is None:
+                    continue  # Failed batch: don't cache, retry on the next run
+                batch_lookup.update(batch_result)
+                total_matches += len(batch_result)
+                for term in batch_data[batch_num - 1][1]:
+                    name_cache[term] = batch_result.get(term)
+                cache_updated = True
+            
+            logging.info(f"Batch processing complete! Found {total_matches} matches across {total_batches} batches.")
 
+            # Most specific matched term, computed once per verbatim string (and once more without
+            # the species term for assays that skip species)
+            best_term_for = {vt: _deepest_matched_term(parsed_by_verbatim[vt], batch_lookup) for vt in {vt for vt, _ in unmatched_tuples}}
+            best_term_without_species_for = {}
+            
             # Apply species-skipping logic with pre-processing
             still_unmatched_batch = []
             for verbatim_str, assay_name in unmatched_tuples:
-                parsed_names = parse_semicolon_taxonomy(verbatim_str)
+                parsed_names = parsed_by_verbatim[verbatim_str]
                 if not parsed_names:  # Skip if no parsed names
                     still_unmatched_batch.append((verbatim_str, assay_name))
                     continue
                 
-                max_depth_for_assay = assay_rank_info.get(assay_name, {}).get('max_depth', 99)
-                is_full_length_taxonomy = (len(parsed_names) >= max_depth_for_assay)
+                is_full_length_taxonomy = (len(parsed_names) >= max_depth_by_assay[assay_name])
                 
                 # Pre-process: Remove last term if this assay should skip species AND has full-length taxonomy
                 if assay_name in assays_to_skip_species and is_full_length_taxonomy:
@@ -318,39 +538,41 @@ def get_worms_match_for_dataframe(occurrence_df, params_dict, n_proc=0):
                     if not parsed_names:  # If nothing left after removal
                         still_unmatched_batch.append((verbatim_str, assay_name))
                         continue
+                    if verbatim_str not in best_term_without_species_for:
+                        best_term_without_species_for[verbatim_str] = _deepest_matched_term(parsed_names, batch_lookup)
+                    term = best_term_without_species_for[verbatim_str]
+                else:
+                    term = best_term_for[verbatim_str]
                 
                 # Store the cleaned taxonomy string that will be used for matching
                 cleaned_taxonomy = ';'.join(parsed_names) if parsed_names else verbatim_str
-                    
-                match_found = False
                 
-                # Check from most specific to least specific (reverse order)
-                for i_term, term in enumerate(reversed(parsed_names)):
-                    # Quick lookup - no complex processing
-                    if term in batch_lookup:
-                        results_cache[(verbatim_str, assay_name)] = {
-                            **batch_lookup[term], 
-                            'nameAccordingTo': api_source, 
-                            'match_type_debug': f'Success_Batch_{term}',
-                            'cleanedTaxonomy': cleaned_taxonomy  # Store what was actually processed
-                        }
-                        match_found = True
-                        break  # Found match, stop looking
-                
-                if not match_found:
+                if term is not None:
+                    results_cache[(verbatim_str, assay_name)] = _make_record(
+                        **batch_lookup[term], 
+                        nameAccordingTo=api_source, 
+                        match_type_debug=f'Success_Batch_{term}',
+                        cleanedTaxonomy=cleaned_taxonomy  # Store what was actually processed
+                    )
+                else:
                     still_unmatched_batch.append((verbatim_str, assay_name))
             
             unmatched_tuples = still_unmatched_batch
             logging.info(f"Stage 2 complete. Found {len(results_cache)} matches. Remaining unmatched: {len(unmatched_tuples)}")
 
+    # Save updated cache
+    if cache_updated:
+        with open(cache_file, 'wb') as f:
+            pickle.dump(worms_cache, f)
+        logging.info(f"Saved {len(aphia_id_cache)} AphiaID and {len(name_cache)} name results to WoRMS cache.")
+
     # --- Handle Final Unmatched ---
     if unmatched_tuples:
         for combo in unmatched_tuples:
             verbatim_str, assay_name = combo
             # Get the cleaned taxonomy for unmatched items
-            parsed_names = parse_semicolon_taxonomy(verbatim_str)
-            max_depth_for_assay = assay_rank_info.get(assay_name, {}).get('max_depth', 99)
-            is_full_length_taxonomy = (len(parsed_names) >= max_depth_for_assay)
+            parsed_names = parsed_by_verbatim[verbatim_str]
+            is_full_length_taxonomy = (len(parsed_names) >= max_depth_by_assay[assay_name])
             
             # Apply same preprocessing as we did during matching
             if assay_name in assays_to_skip_species and is_full_length_taxonomy and parsed_names:
@@ -358,42 +580,37 @@ def get_worms_match_for_dataframe(occurrence_df, params_dict, n_proc=0):
             
             cleaned_taxonomy = ';'.join(parsed_names) if parsed_names else verbatim_str
             
-            no_match_record = {
-                'scientificName': 'incertae sedis',
-                'scientificNameID': 'urn:lsid:marinespecies.org:taxname:12',
-                'taxonRank': None,
-                'nameAccordingTo': api_source,
-                'match_type_debug': 'Failed_All_Stages_NoMatch',
-                'cleanedTaxonomy': cleaned_taxonomy
-            }
-            for col in DWC_RANKS_STD:
-                no_match_record[col] = None
-
-            results_cache[combo] = no_match_record
+            results_cache[combo] = _make_record(
+                **incertae_sedis_base,
+                match_type_debug='Failed_All_Stages_NoMatch',
+                cleanedTaxonomy=cleaned_taxonomy
+            )
 
     # --- Create record for initially empty inputs ---
     # Note: Empty inputs are now handled earlier in the process with 'incertae sedis'
-    results_cache['IS_TRULY_EMPTY'] = { 
-        'scientificName': 'incertae sedis',
-        'scientificNameID': 'urn:lsid:marinespecies.org:taxname:12',
-        'taxonRank': None,
-        'nameAccordingTo': api_source,
-        'match_type_debug': 'incertae_sedis_truly_empty_fallback',
-        'cleanedTaxonomy': ''  # Empty string for truly empty inputs
-    }
-    for col in DWC_RANKS_STD:
-        results_cache['IS_TRULY_EMPTY'][col] = None
+    results_cache['IS_TRULY_EMPTY'] = _make_record(
+        **incertae_sedis_base,
+        match_type_debug='incertae_sedis_truly_empty_fallback',
+        cleanedTaxonomy=''  # Empty string for truly empty inputs
+    )
 
     # --- Apply results to DataFrame ---
+    df_to_process = occurrence_df
     if results_cache:
-        mapped_results = df_to_process['_map_key'].map(results_cache)
-        results_df = pd.DataFrame(mapped_results.to_list(), index=df_to_process.index)
+        results_by_key = {key: results_cache[combo] for key, combo in tuple_by_key.items()}
+        results_by_key['IS_TRULY_EMPTY'] = results_cache['IS_TRULY_EMPTY']
+        # Build one row per distinct key, then expand to all rows by categorical code
+        key_cat = pd.Categorical(map_key)
+        unique_results_df = pd.DataFrame.from_records([results_by_key[key] for key in key_cat.categories], columns=RESULT_COLUMNS)
+        results_df = unique_results_df.take(key_cat.codes)
+        results_df.index = occurrence_df.index
         
-        # Apply results to existing columns AND add new columns like cleanedTaxonomy
-        for col in results_df.columns:
-            df_to_process[col] = results_df[col]
-
-    df_to_process.drop(columns=['_map_key'], inplace=True, errors='ignore')
+        # Replace existing taxonomy columns AND add new columns like cleanedTaxonomy in a single concat.
+        # drop() returns a new frame, so the caller's DataFrame is never modified
+        df_to_process = pd.concat(
+            [occurrence_df.drop(columns=[col for col in results_df.columns if col in occurrence_df.columns]), results_df],
+            axis=1, **_CONCAT_NO_COPY
+        )
     
     return df_to_process
 